@@ -10,101 +10,182 @@ other functions useful for producing and analyzing skymaps.
 
 #FIXME: standardize notation for m, n, etc (which paper did I use?)
 
+import hashlib
+
 import numpy as np
 import healpy as hp
 import pandas as pd
+from numba import njit, prange
 
 
 # FIXME: add the time/freq array generator routines for convenience
 
+# antenna patterns for the most recently used pulsar/source geometries
+# (only filled when antenna_patterns is called with cache=True)
+_antenna_cache = {}
+_ANTENNA_CACHE_SIZE = 4
+
 
 def map_pixels(nside):
     """
-    Returns a dataframe of the angle for each pixel in a given healpix
-    pixelization. Columns: theta, phi.  Index gives the pixel number
+    Returns arrays (theta, phi) of the angle for each pixel in a given healpix
+    pixelization, ordered by pixel number. Can be passed directly as psr to
+    residuals_time.
     """
     npix = hp.nside2npix(nside)
     theta, phi = hp.pix2ang(nside, np.arange(npix))
+
+    return theta, phi
+
+
+def map_pixels_df(nside):
+    """
+    Returns a dataframe of the angle for each pixel in a given healpix
+    pixelization. Columns: theta, phi.  Index gives the pixel number
+    """
+    theta, phi = map_pixels(nside)
     pixels = pd.DataFrame({'phi': phi, 'theta': theta})
 
     return pixels
 
 
-def source_vectors(theta, phi):
+def source_vectors(theta, phi, dtype=np.float64):
     """
     Produces vectors along the polarization axes and the direction of GW
-    propagation for sources at (theta, phi).
+    propagation for sources at (theta, phi). Returns arrays (k, l, m), each
+    of shape (num(src), 3) and type dtype.
     """
     # theta, phi is the direction to the source
     # everything below needs the direction of GW propagation
-    theta_prop = np.pi - theta
-    phi_prop = np.pi + phi
+    theta_prop = np.pi - np.asarray(theta, dtype=dtype)
+    phi_prop = np.pi + np.asarray(phi, dtype=dtype)
 
-    # observer's frame tangential components
-    l = pd.DataFrame({('l', 'x'): np.cos(theta_prop)*np.cos(phi_prop),
-                      ('l', 'y'): np.cos(theta_prop)*np.sin(phi_prop),
-                      ('l', 'z'): -np.sin(theta_prop)})
-    m = pd.DataFrame({('m', 'x'): -np.sin(phi_prop),
-                      ('m', 'y'): np.cos(phi_prop),
-                      ('m', 'z'): 0.})
+    sin_theta, cos_theta = np.sin(theta_prop), np.cos(theta_prop)
+    sin_phi, cos_phi = np.sin(phi_prop), np.cos(phi_prop)
 
-    k = pd.DataFrame({('k', 'x'): np.sin(theta_prop)*np.cos(phi_prop),
-                      ('k', 'y'): np.sin(theta_prop)*np.sin(phi_prop),
-                      ('k', 'z'): np.cos(theta_prop)})
+    # observer's frame tangential components
+    l = np.column_stack((cos_theta*cos_phi, cos_theta*sin_phi, -sin_theta))
+    m = np.column_stack((-sin_phi, cos_phi, np.zeros_like(phi_prop)))
 
-    src_vecs = k.join([l, m])
-    src_vecs.index.name = 'src'
+    k = np.column_stack((sin_theta*cos_phi, sin_theta*sin_phi, cos_theta))
 
-    return src_vecs
+    return k, l, m
 
 
-def pulsar_vectors(theta, phi):
+def pulsar_vectors(theta, phi, dtype=np.float64):
     """
-    Produces a pandas dataframe of Cartesian vectors in the direction of each
-    pulsar at (theta, phi).
+    Produces an array of Cartesian vectors in the direction of each pulsar at
+    (theta, phi), with shape (num(psr), 3) and type dtype.
     """
-    psr_vecs = pd.DataFrame({'x': np.sin(theta)*np.cos(phi),
-                             'y': np.sin(theta)*np.sin(phi),
-                             'z': np.cos(theta)})
-    psr_vecs.index.name = 'psr'
+    theta = np.asarray(theta, dtype=dtype)
+    phi = np.asarray(phi, dtype=dtype)
+    sin_theta, cos_theta = np.sin(theta), np.cos(theta)
+    psr_vecs = np.column_stack((sin_theta*np.cos(phi),
+                                sin_theta*np.sin(phi),
+                                cos_theta))
     return psr_vecs
 
 
-def antenna_patterns(theta_psr, phi_psr, theta_src, phi_src):
+def as_dataframe(vecs):
+    """
+    Produces a pandas dataframe from the output of pulsar_vectors (columns
+    x, y, z; index psr) or source_vectors (columns k, l, m for each of x, y,
+    z; index src).
+    """
+    if isinstance(vecs, tuple):
+        vecs_df = pd.concat({name: pd.DataFrame(v, columns=['x', 'y', 'z'])
+                             for name, v in zip(['k', 'l', 'm'], vecs)},
+                            axis=1)
+        vecs_df.index.name = 'src'
+    else:
+        vecs_df = pd.DataFrame(vecs, columns=['x', 'y', 'z'])
+        vecs_df.index.name = 'psr'
+    return vecs_df
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _antenna_kernel(p, k, l, m, plus, cross):
+    """
+    Fill plus, cross (num(psr), num(src)) with the antenna patterns for
+    pulsar vectors p and source vectors k, l, m in a single pass.
+    """
+    for i in prange(p.shape[0]):
+        px, py, pz = p[i, 0], p[i, 1], p[i, 2]
+        for j in range(k.shape[0]):
+            pk = px*k[j, 0] + py*k[j, 1] + pz*k[j, 2]
+            pl = px*l[j, 0] + py*l[j, 1] + pz*l[j, 2]
+            pm = px*m[j, 0] + py*m[j, 1] + pz*m[j, 2]
+            denom = 1.0 + pk
+            plus[i, j] = 0.5*(pl*pl - pm*pm)/denom
+            cross[i, j] = pl*pm/denom
+
+
+def antenna_patterns(theta_psr, phi_psr, theta_src, phi_src, dtype=np.float64,
+                     cache=False):
     """
     Plus and cross polarization patterns for all pulsar locations at
     (theta_psr, phi_psr) given a set of sources in the directions
     (theta_src, phi_src).
 
     This routine does the heavy lifting of all the dot products between
-    sources and pulsar pixels.
+    sources and pulsar pixels. Returns an array of shape
+    (2, num(psr), num(src)); the first axis is the polarization
+    (cross, plus). Use dtype=np.float32 to halve the memory needed.
+
+    If cache, results are cached on the pulsar and source positions, so
+    repeated calls with the same geometry (e.g. for many sets of times) are
+    cheap, and the returned array is read-only. Caching is off by default: up
+    to _ANTENNA_CACHE_SIZE full-size arrays are kept alive by the cache, which
+    only pays off when the same geometry is reused (not e.g. for a new source
+    population on every call).
     """
-
-    p = pulsar_vectors(theta_psr, phi_psr)  # directions to pulsars
-    s = source_vectors(theta_src, phi_src)  # source direction, pol basis
-
-    # in order to create all dot product combinations, need to align p, s
-    # memory pressure is an issue here since need ~num(psr)*num(src) rows
-    # the following increases the size of p, but NOT s (hopefully)
-    ps_index = pd.MultiIndex.from_product((p.index, s.index),
-                                           names=('psr', 'src'))
-    p = p.reindex(index=ps_index, level='psr')
-    dot = pd.DataFrame({'pk': p.mul(s['k']).sum(axis=1),
-                        'pl': p.mul(s['l']).sum(axis=1),
-                        'pm': p.mul(s['m']).sum(axis=1)})
-
-
-    # make df of antenna pattern values for each pulsar & source combination
+    if cache:
+        key = (np.dtype(dtype).str,
+               _geometry_key(theta_psr, phi_psr, theta_src, phi_src))
+    if cache and key in _antenna_cache:
+        # move to the end so that eviction drops the least recently used
+        _antenna_cache[key] = _antenna_cache.pop(key)
+        return _antenna_cache[key]
+
+    p = pulsar_vectors(theta_psr, phi_psr, dtype)  # directions to pulsars
+    k, l, m = source_vectors(theta_src, phi_src, dtype)  # src dir, pol basis
+
+    # antenna pattern values for each pulsar & source combination
     # sum over sources *after* multiplying by source amplitudes
     # note that convention for plus, cross is wrt source orientation, not observer
     # effect of psi is in the definition of +,x amplitudes
-    antenna = pd.DataFrame({'plus': 0.5*(dot.pl**2 - dot.pm**2)/(1 + dot.pk),
-                            'cross': dot.pl*dot.pm/(1 + dot.pk)})
-    antenna.columns.set_names('pol', inplace=True)
+    antenna = np.empty((2, p.shape[0], k.shape[0]), dtype=dtype)
+    _antenna_kernel(p, k, l, m, antenna[1], antenna[0])
+
+    if cache:
+        antenna.flags.writeable = False
+        # drop the least recently used geometry once the cache is full
+        if len(_antenna_cache) >= _ANTENNA_CACHE_SIZE:
+            del _antenna_cache[next(iter(_antenna_cache))]
+        _antenna_cache[key] = antenna
 
     return antenna
 
 
+def clear_antenna_cache():
+    """
+    Remove all cached antenna patterns.
+    """
+    _antenna_cache.clear()
+
+
+def _geometry_key(*angles):
+    """
+    Hash of a set of angle arrays, used to look up cached antenna patterns.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for angle in angles:
+        angle = np.ascontiguousarray(angle, dtype=float)
+        digest.update(str(angle.shape).encode())
+        digest.update(angle.tobytes())
+    return digest.hexdigest()
+
+
 def hplus_hcross(src, domain='freq', timeseries=np.zeros(1)):
     """
     Get the components of hplus, hcross for each source given its parameters.
@@ -112,112 +193,145 @@ def hplus_hcross(src, domain='freq', timeseries=np.zeros(1)):
     polarization in the frequency domain (for real frequencies only).
     If domain is 'time' (or begins with 't'), calculate for the timeseries.
     """
-    a, b = inclination(src['iota'])
-    cos2psi = np.cos(2*src['psi'])
-    sin2psi = np.sin(2*src['psi'])
-    sinPhi0 = np.sin(src['Phi0'])
-    cosPhi0 = np.cos(src['Phi0'])
-
-    if domain[0] is 'f':
-        plus = 0.5*src['A']*(a*cos2psi*(cosPhi0 + 1j*sinPhi0) +
-                             b*sin2psi*(sinPhi0 - 1j*cosPhi0))
-        cross = 0.5*src['A']*(b*cos2psi*(sinPhi0 - 1j*cosPhi0) -
-                              a*sin2psi*(cosPhi0 + 1j*sinPhi0))
-        plus.name = 'plus'
-        cross.name = 'cross'
-    #elif domain[0] is 't':
+    A = src['A'].values
+    iota = src['iota'].values
+    psi = src['psi'].values
+    Phi0 = src['Phi0'].values
+
+    a, b = inclination(iota)
+    cos2psi = np.cos(2*psi)
+    sin2psi = np.sin(2*psi)
+    # cos(Phi0) + i sin(Phi0) = exp(i Phi0)
+    # sin(Phi0) - i cos(Phi0) = -i exp(i Phi0)
+    amp = 0.5*A*np.exp(1j*Phi0)
+
+    if domain[0] == 'f':
+        plus = amp*(a*cos2psi - 1j*b*sin2psi)
+        cross = amp*(-1j*b*cos2psi - a*sin2psi)
+    #elif domain[0] == 't':
     # do time calculations
 
-    h = pd.concat([cross, plus], axis=1)
-    h.index.name = 'pol'
+    h = pd.DataFrame(np.column_stack([cross, plus]), index=src.index,
+                     columns=pd.Index(['cross', 'plus'], name='pol'))
     return h
 
 
 def redshift(theta_psr, phi_psr, A_src, theta_src, phi_src,
-             iota_src=0.0, Phi_src=0.0, Phi0_src=0.0, psi_src=0.0):
+             iota_src=0.0, Phi_src=0.0, Phi0_src=0.0, psi_src=0.0,
+             cache=False):
     """
     Produce single-epoch list of redshifts at pulsars at (theta_psr, phi_psr)
     for GW sources with properties: A (amplitude), iota (inclination),
     Phi (phase), Phi0 (initial phase), psi (polarization angle).
+    Returns an array of redshifts, one per pulsar. If cache, reuse the
+    antenna patterns for repeated geometries (see antenna_patterns).
     """
 
-    a =  1 + np.cos(iota_src)**2
-    b = - 2*np.cos(iota_src)
+    a, b = inclination(iota_src)
 
-    h = pd.DataFrame({'plus': a*A_src*np.cos(Phi_src + Phi0_src),
-                      'cross': b*A_src*np.sin(Phi_src + Phi0_src)})
+    # strain in each polarization (cross, plus) for each source
+    phase = Phi_src + Phi0_src
+    h = np.stack((b*A_src*np.sin(phase),
+                  a*A_src*np.cos(phase)))
 
-    F = antenna_patterns(theta_psr, phi_psr, theta_src, phi_src)
+    F = antenna_patterns(theta_psr, phi_psr, theta_src, phi_src,
+                         cache=cache)
 
     # assume pulsar term is 0
     # multiply h and F for each source then sum over sources and polarizations
-    z = -h.mul(F, level='src').sum(level='psr').sum(axis=1)
+    z = -(F[0] @ h[0] + F[1] @ h[1])
 
     return z
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _wave_kernel(freq, phi0, times, zero_r0, waves):
+    """
+    Fill waves (2, num(src), num(time)) with the sine (cross) and cosine
+    (plus) terms for each source at each time in a single pass. If zero_r0,
+    subtract off the values at the initial phase.
+    """
+    for i in prange(freq.shape[0]):
+        if zero_r0:
+            sin_IC = np.sin(phi0[i])
+            cos_IC = np.cos(phi0[i])
+        else:
+            sin_IC = 0.
+            cos_IC = 0.
+        for j in range(times.shape[0]):
+            phase = 2*np.pi*freq[i]*times[j] + phi0[i]
+            waves[0, i, j] = np.sin(phase) - sin_IC
+            waves[1, i, j] = np.cos(phase) - cos_IC
+
+
 # this is the key function
 # should probably have more loops and less giant arrays
-def residuals_time(src, psr, times=np.zeros(1), zero_r0=False):
+def residuals_time(src, psr, times=np.zeros(1), zero_r0=False,
+                   dtype=np.float64, cache=False):
     """
     Calculate the timing residuals for each pulsar at each observation time,
     given a list of monochromatic sources. If zero_r0, the timing residuals
     will be calculated relative to their initial values.
+    psr is either a dataframe with columns theta, phi (rows are labelled by
+    its index) or a pair of arrays (theta, phi) as returned by map_pixels
+    (rows are labelled by position, i.e. pixel number).
+    The antenna patterns and source waves are stored as dtype; use np.float32
+    to halve the memory needed (the wave phases are still computed in double
+    precision). If cache, reuse the antenna patterns when called repeatedly
+    with the same pulsars and sources (see antenna_patterns).
     """
-
-    # get signal from each src in both polarizations at all times
-    tt, ff = np.meshgrid(times, src['zf'])
-    tt, phiphi = np.meshgrid(times, src['Phi0'])
-    wave_index = pd.MultiIndex.from_product([['cross', 'plus'], times],
-                                            names=['pol', 'time'])
-    if zero_r0:
-        # will want to subtract the timing residual for the initial phase
-        sin_IC = -np.sin(phiphi)
-        cos_IC = -np.cos(phiphi)
+    A = src['A'].values
+    zf = src['zf'].values
+    iota = src['iota'].values
+    Phi0 = src['Phi0'].values
+
+    if isinstance(psr, tuple):
+        theta_psr, phi_psr = psr
+        psr_index = pd.RangeIndex(len(theta_psr), name='psr')
     else:
-        # don't subtract off initial value
-        sin_IC = 0.
-        cos_IC = 0.
+        theta_psr, phi_psr = psr['theta'], psr['phi']
+        psr_index = psr.index.rename('psr')
 
+    # get signal from each src in both polarizations at all times
     # amplitude from sine and cosine terms (function of time)
+    # shape (2, num(src), num(time)); first axis is pol (cross, plus)
     #FIXME: need to rotate h+, hx:
     #h+' = h+*cos(2psi) + hx*sin(2psi)
     #hx' = -h+*sin(2psi) + hx*cos(2psi)
-    wave_values = np.hstack((np.sin(2*np.pi*ff*tt + phiphi) + sin_IC,
-                             np.cos(2*np.pi*ff*tt + phiphi) + cos_IC))
-    waves = pd.DataFrame(data=wave_values, columns=wave_index,
-                         index=src.index)
+    times = np.asarray(times, dtype=float)
+    waves = np.empty((2, len(src.index), len(times)), dtype=dtype)
+    _wave_kernel(zf, Phi0, times, zero_r0, waves)
+
     # amplitudes based on source properties (not time dependent)
-    a, b = inclination(src['iota'])
-    amps = pd.DataFrame({'cross': b*src['A']/(2*np.pi*src['zf']),
-                         'plus': a*src['A']/(2*np.pi*src['zf'])})
+    a, b = inclination(iota)
+    amps = np.stack((b, a))*(A/(2*np.pi*zf))
 
     # total strain amplitude in each polarization at each time for each source
-    waves = amps.mul(waves, level='pol')
-    del amps
+    np.multiply(waves, amps[:, :, None], out=waves)
 
     # antenna patterns for each pulsar-source combination
-    F = antenna_patterns(psr['theta'], psr['phi'], src['theta'],
-                         src['phi'])
-
-    # expand waves so that each pulsar gets a copy of all sources
-    waves = waves.reindex(index=F.index, level='src')
+    F = antenna_patterns(theta_psr, phi_psr, src['theta'], src['phi'],
+                         dtype=dtype, cache=cache)
 
     # timing residuals (in s) for each psr: sum of waves*antenna patterns
-    # over all polarizations and sources
-    residuals = F.mul(waves, level='pol').sum(level='psr').sum(axis=1, level='time')
+    # over all sources, then accumulate over polarizations
+    residuals = F[0] @ waves[0]
+    residuals += F[1] @ waves[1]
+    residuals = pd.DataFrame(residuals,
+                             index=psr_index,
+                             columns=pd.Index(times, name='time'))
 
     return residuals
 
 
-# FIXME: incorporate into other code
 def inclination(iota):
     """
     A vector showing the components in the plus and cross polarization
     produced for a given inclination.
     a(iota), b(iota) in the notation of Sesana & Vecchio 2010.
     """
-    a =  1 + np.cos(iota)**2
-    b = -2*np.cos(iota)
+    cos_iota = np.cos(iota)
+    a = 1 + cos_iota*cos_iota
+    b = -2*cos_iota
 
     return a, b
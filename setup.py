@@ -6,5 +6,5 @@ setup(name='plotGWB',
       packages=['plotGWB'],
       python_requires='>=3',
       install_requires=['numpy', 'scipy', 'pandas', 'healpy', 'matplotlib',
-                        'cycler', 'seaborn']
+                        'cycler', 'seaborn', 'numba']
       )